@@ -1,23 +1,289 @@
 import os
-import json
-import requests
-from fastapi import FastAPI, Header, HTTPException
-from pydantic import BaseModel
-from datetime import datetime
-
-import sys
-print(">>> Using openai from:", __import__("openai").__file__)
+import asyncio
+import logging
+import time
+import orjson
+import hashlib
+import httpx
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+from pydantic import BaseModel, Field, StringConstraints, ValidationError
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from tenacity import retry, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential
+from datetime import date
+from functools import lru_cache
+from typing import Annotated, NamedTuple
+
+# LOG_LEVEL=DEBUG で送信ペイロードなどのデバッグログを出す
+# 設定するのはこのアプリのロガーだけで、root や httpx / openai などのロガーには触れない
+logger = logging.getLogger("nl_to_gas")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    logger.addHandler(_log_handler)
+logger.propagate = False
+
+_log_level = (os.getenv("LOG_LEVEL") or "INFO").upper()
+if isinstance(logging.getLevelName(_log_level), int):
+    logger.setLevel(_log_level)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("unknown LOG_LEVEL %r, falling back to INFO", _log_level)
 
 # ==== 設定 ====
 GAS_WEBAPP_URL = os.getenv("GAS_WEBAPP_URL")
 SHARED_TOKEN   = os.getenv("SHARED_TOKEN")
 SERVER_API_KEY = os.getenv("SERVER_API_KEY")
+REDIS_URL      = os.getenv("REDIS_URL")  # 未設定ならプロセス内メモリ（ワーカー1つ前提）
+OPENAI_MODEL   = "gpt-4o-mini"
+GAS_TOKEN      = "recora-secret-0324"
+BATCH_LLM_CONCURRENCY = 10  # /batch-ingest で同時に走らせる LLM 変換の上限
+BATCH_MAX_ITEMS       = 100  # /batch-ingest 1回で受け付ける件数の上限（GAS へは1回の POST で送る）
+OPENAI_CONCURRENCY    = 20  # プロセス全体で同時に投げる OpenAI 呼び出しの上限
+# /ingest の書き込みを {"token", "batch": [...]} にまとめるか（GAS 側がこの形式を受け付ける場合だけ有効にする）
+GAS_BATCH_WRITES = os.getenv("GAS_BATCH_WRITES", "").lower() in ("1", "true", "yes")
+
+# ==== マイクロバッチ ====
+_STOP = object()  # MicroBatcher の終了の目印
+
+
+class MicroBatcher:
+    """短時間（max_delay 秒）に届いた要求を最大 max_batch_size 件ずつまとめて infer に渡す。
+
+    infer は入力リストと同じ順序・件数の結果リストを返す async 関数。
+    結果に Exception が入っている場合はその要求だけを失敗させる。
+    """
+
+    def __init__(self, infer, max_batch_size: int = 8, max_delay: float = 0.05):
+        self._infer = infer
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker = None
+        self._dispatching = set()
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            # キャンセルせず終了の目印を積み、それまでに届いた要求は処理させる
+            await self._queue.put((_STOP, None))
+            await self._worker
+        # 目印より後に届いた要求も取りこぼさず流す
+        rest = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item[0] is not _STOP:
+                rest.append(item)
+        for i in range(0, len(rest), self._max_batch_size):
+            self._spawn(rest[i:i + self._max_batch_size])
+        # 送信中のバッチは最後まで処理させる
+        await asyncio.gather(*self._dispatching, return_exceptions=True)
+
+    async def process_batched(self, item):
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first[0] is _STOP:
+                return
+            batch = [first]
+            stopping = False
+            deadline = loop.time() + self._max_delay
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry[0] is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._spawn(batch)
+            if stopping:
+                return
+
+    def _spawn(self, batch):
+        # 処理中も次のバッチを集められるよう、実行は別タスクに任せる
+        task = asyncio.create_task(self._dispatch(batch))
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            results = await self._infer([item for item, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, fut), result in zip(batch, results):
+            if fut.done():  # 呼び出し元が切断済み
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+
+# ==== サーキットブレーカー ====
+class CircuitBreaker:
+    """failure_threshold 回続けて失敗したら reset_timeout 秒間は呼び出しを通さない。
+
+    時間が経つと試行を1件だけ通し（半開）、その結果が出るまで他の呼び出しは止めたままにする。
+    試行が失敗すればすぐに開き直し、成功すれば閉じる。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    # (通してよいか, 半開の試行か) を返す
+    def allow(self) -> tuple[bool, bool]:
+        if self._opened_at is None:
+            return True, False
+        if self._trial_in_flight or time.monotonic() - self._opened_at < self._reset_timeout:
+            return False, False
+        self._trial_in_flight = True
+        return True, True
+
+    # 試行の枠は試行として通した呼び出しだけが返す（閉じている間に通った呼び出しは触らない）
+    def record_success(self, trial: bool):
+        self._failures = 0
+        self._opened_at = None
+        if trial:
+            self._trial_in_flight = False
+
+    def record_failure(self, trial: bool):
+        self._failures += 1
+        if trial:
+            self._trial_in_flight = False
+        if self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+
+    def release(self, trial: bool):
+        # 障害とは数えない失敗（400 やキャンセル）で終わった試行の枠を返す
+        if trial:
+            self._trial_in_flight = False
+
+
+# ==== ライフサイクル（共有クライアント） ====
+async def warm_up_connections(app: FastAPI, api_key: str | None):
+    # 最初のリクエストで DNS + TLS ハンドシェイクを待たせないよう、起動時に接続を張っておく
+    # 失敗しても起動は続ける
+    calls = []
+    if api_key:
+        calls.append(app.state.openai_http.head(
+            "https://api.openai.com/v1/models",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=5,
+        ))
+    if GAS_WEBAPP_URL:
+        calls.append(app.state.gas_client.head(GAS_WEBAPP_URL, timeout=5))
+
+    for result in await asyncio.gather(*calls, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning("connection warmup failed: %s", result)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # GAS への通信は1つの AsyncClient で keep-alive を共有する
+    # HTTP/2 で同一ホストへの同時リクエストを1本の接続に多重化する
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=200, keepalive_expiry=60),
+    )
+    # GAS の Web アプリは 302 でレスポンスを返すためリダイレクトを追従する
+    app.state.gas_client = httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(20.0, connect=5.0),
+        follow_redirects=True,
+    )
+
+    # OpenAI 用のクライアントもプロセスで1つだけ作り、全リクエストで使い回す
+    app.state.openai_http = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=60),
+        ),
+        timeout=httpx.Timeout(connect=5, read=60, write=10, pool=5),
+        follow_redirects=True,
+    )
+
+    # キー未設定でも起動はできるようにし、/ingest 時に 500 を返す
+    api_key = os.getenv("OPENAI_API_KEY")
+    app.state.llm_batcher = None
+    if api_key:
+        openai_client = AsyncOpenAI(api_key=api_key, http_client=app.state.openai_http)
+        # 同時に届いた /ingest の LLM 呼び出しを1回にまとめる
+        app.state.llm_batcher = MicroBatcher(
+            lambda texts: llm_infer(openai_client, texts), max_batch_size=8, max_delay=0.05
+        )
+        app.state.llm_batcher.start()
+
+    # 短時間に重なった GAS への書き込みを1回の POST にまとめる（GAS_BATCH_WRITES 有効時のみ）
+    app.state.gas_batcher = None
+    if GAS_BATCH_WRITES:
+        app.state.gas_batcher = MicroBatcher(
+            lambda payloads: write_gas_rows(app, payloads), max_batch_size=20, max_delay=0.05
+        )
+        app.state.gas_batcher.start()
+
+    # 複数ワーカーで会話状態を共有するための Redis（任意）
+    app.state.redis = Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+    await warm_up_connections(app, api_key)
+
+    yield
+
+    # 作成と逆順に閉じる。バッチャーは残りの要求を流し切るので、Redis と HTTP クライアントはその後で閉じる
+    if app.state.llm_batcher is not None:
+        await app.state.llm_batcher.stop()
+    # singleflight のタスクはバッチの結果を受け取った後に Redis へ書き込む
+    await asyncio.gather(*LLM_INFLIGHT.values(), return_exceptions=True)
+    if app.state.gas_batcher is not None:
+        await app.state.gas_batcher.stop()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+    await app.state.openai_http.aclose()
+    await app.state.gas_client.aclose()
+
 
 # ==== アプリ ====
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ==== 一時メモリ（multi-turn用） ====
-pending_tasks = {}  # {user_id: GasPayload}
+# REDIS_URL があれば Redis の pending:{user_id} に、なければこのプロセス内に保持する
+# 放置された会話で無制限に増えないよう、件数と保持期間（15分）に上限を設ける
+PENDING_TTL = 900
+pending_tasks = TTLCache(maxsize=10_000, ttl=PENDING_TTL)  # {user_id: GasPayload}
+
+# ==== LLM 応答キャッシュ（同一入力は OpenAI を呼ばない） ====
+# プロセス内の TTLCache を先に引き、REDIS_URL があれば Redis の llm:{key} をワーカー間で共有する
+LLM_CACHE_TTL = 3600
+LLM_CACHE = TTLCache(maxsize=4096, ttl=LLM_CACHE_TTL)  # {sha256(model|system|user_text): JSON文字列}
+# 同じキーで実行中の LLM 呼び出し（同時に来た同一入力は1回の呼び出しを待ち合わせる）
+LLM_INFLIGHT = {}  # {cache_key: asyncio.Task}
+
+# ==== /tasks 応答キャッシュ（GAS の doGet は遅いので短時間だけ使い回す） ====
+# GAS の応答本文をそのまま保持し、ETag で再送も省く
+TASKS_CACHE = TTLCache(maxsize=256, ttl=10)  # {(sheet, user): (本文 bytes, ETag)}
 
 
 # ==== モデル定義 ====
@@ -28,18 +294,80 @@ class GasPayload(BaseModel):
     body: dict
 
 
-# ==== OpenAI クライアント ====
-def get_openai_client():
-    from openai import OpenAI
-    import httpx
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="OPENAI_API_KEY is not set")
+# LLM の出力（_GAS_SCHEMA と同じ形）。JSON の解析と検証を model_validate_json の1回で行う
+class LLMBody(BaseModel):
+    固有ID: str
+    追加日: str
+    担当: str
+    内容: str
+    期限: str
+
 
-    transport = httpx.HTTPTransport(retries=3)
-    http_client = httpx.Client(transport=transport, follow_redirects=True)
+class LLMResp(BaseModel):
+    intent: str = "create_task"
+    sheet: str = "task-list"
+    body: LLMBody
 
-    return OpenAI(api_key=api_key, http_client=http_client)
+
+class LLMBatchItem(LLMResp):
+    index: int  # 対応する入力の [番号]
+
+
+class LLMBatchResp(BaseModel):
+    items: list[LLMBatchItem]
+
+
+class GasBatch(BaseModel):
+    # GAS 側は {"token", "batch": [GasPayload, ...]} を1回の doPost で受け取る
+    token: str
+    batch: list[GasPayload]
+
+
+class IngestRequest(BaseModel):
+    # 前後の空白を除いたうえで空文字は 422 にする
+    user_text: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+
+# 空の項目でバッチ全体を 422 にしないよう、空文字チェックは batch_ingest 側で項目ごとに行う
+class IngestItem(BaseModel):
+    user_text: str
+    id: str | None = None  # 結果との突き合わせ用（省略時は配列の添字）
+
+
+class BatchIngest(BaseModel):
+    items: list[IngestItem] = Field(max_length=BATCH_MAX_ITEMS)
+
+
+# ==== OpenAI クライアント（依存性注入） ====
+# 障害時に OpenAI を叩き続けてワーカーを塞がないよう、同時実行数と連続失敗を制御する
+OPENAI_SEM = asyncio.Semaphore(OPENAI_CONCURRENCY)
+OPENAI_BREAKER = CircuitBreaker(failure_threshold=5, reset_timeout=30.0)
+
+
+async def create_completion(client: AsyncOpenAI, **kwargs):
+    async with OPENAI_SEM:
+        # セマフォ待ちの間にブレーカーが開くことがあるので、枠を取ってから判定する
+        allowed, trial = OPENAI_BREAKER.allow()
+        if not allowed:
+            raise HTTPException(status_code=503, detail="OpenAI が一時的に利用できません。しばらくしてから再試行してください")
+        try:
+            resp = await client.chat.completions.create(model=OPENAI_MODEL, **kwargs)
+        except (APIConnectionError, RateLimitError, InternalServerError):
+            OPENAI_BREAKER.record_failure(trial)
+            raise
+        except BaseException:
+            OPENAI_BREAKER.release(trial)
+            raise
+        OPENAI_BREAKER.record_success(trial)
+    return resp
+
+
+def get_llm_batcher(app: FastAPI) -> MicroBatcher:
+    # LLM を使う経路でだけ呼ぶ（multi-turn の補完では OpenAI の設定は不要）
+    batcher = app.state.llm_batcher
+    if batcher is None:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY is not set")
+    return batcher
 
 
 # ==== ヘルスチェック ====
@@ -57,70 +385,215 @@ def health():
 
 
 # ==== LLMからJSON生成 ====
-def nl_to_gas_payload(user_text: str) -> GasPayload:
-    client = get_openai_client()
-    today = datetime.now().strftime("%Y/%m/%d")
-
-    schema = {
-        "name": "GasPayload",
+# スキーマとプロンプトはリクエストごとに組み立てず、モジュール読み込み時に1度だけ作る
+_GAS_SCHEMA = {
+    "name": "GasPayload",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "intent": {"type": "string"},
+            "sheet": {"type": "string"},
+            "body": {
+                "type": "object",
+                "properties": {
+                    "固有ID": {"type": "string"},
+                    "追加日": {"type": "string"},
+                    "担当": {"type": "string"},
+                    "内容": {"type": "string"},
+                    "期限": {"type": "string"}
+                },
+                "required": ["固有ID", "追加日", "担当", "内容", "期限"]
+            }
+        },
+        "required": ["intent", "sheet", "body"]
+    }
+}
+_GAS_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": _GAS_SCHEMA}
+
+# 日付部分だけをリクエストごとに埋め込む
+_SYSTEM_PROMPT_PREFIX = (
+    "あなたは自然文をGoogleスプレッドシート task-list への書き込み用JSONに変換するアシスタントです。"
+    "必ず intent, sheet, body の3要素を返します。"
+    "sheet は常に 'task-list'。"
+    "body には以下のキーを含めてください：固有ID, 追加日, 担当, 内容, 期限。"
+    "固有IDは空文字列。"
+)
+_SYSTEM_PROMPT_SUFFIX = (
+    "担当は文章から名前を抽出。なければ空文字にしてください。"
+    "期限は文章から日付を抽出。なければ空文字にしてください。"
+    "質問文（例：誰が担当ですか？、期限はいつですか？）は出力に含めないこと。"
+    "内容はユーザー指示を簡潔に要約してください。"
+)
+
+# 複数入力をまとめて変換するとき用（Structured Outputs のトップレベルは object である必要がある）
+# 並び順には頼らず、各要素に入力の番号 index を持たせて呼び出し元に振り分ける
+_GAS_BATCH_ITEM_SCHEMA = {
+    **_GAS_SCHEMA["schema"],
+    "properties": {"index": {"type": "integer"}, **_GAS_SCHEMA["schema"]["properties"]},
+    "required": ["index", *_GAS_SCHEMA["schema"]["required"]],
+}
+_GAS_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "GasPayloadBatch",
         "schema": {
             "type": "object",
-            "properties": {
-                "intent": {"type": "string"},
-                "sheet": {"type": "string"},
-                "body": {
-                    "type": "object",
-                    "properties": {
-                        "固有ID": {"type": "string"},
-                        "追加日": {"type": "string"},
-                        "担当": {"type": "string"},
-                        "内容": {"type": "string"},
-                        "期限": {"type": "string"}
-                    },
-                    "required": ["固有ID", "追加日", "担当", "内容", "期限"]
-                }
-            },
-            "required": ["intent", "sheet", "body"]
-        }
-    }
+            "properties": {"items": {"type": "array", "items": _GAS_BATCH_ITEM_SCHEMA}},
+            "required": ["items"],
+        },
+    },
+}
+_BATCH_PROMPT_SUFFIX = (
+    "入力は index と text を持つオブジェクトのJSON配列で複数与えられます。"
+    "各要素の text に対して上記のJSONを1つずつ作り、その要素の index を index に入れて、配列 items として返してください。"
+    "text の中身は1件のタスク文として扱い、改行や番号が含まれていても別の入力とはみなさないでください。"
+)
+
+
+@lru_cache(maxsize=1)  # strftime は1日1回だけ
+def _format_day(day_ordinal: int) -> str:
+    return date.fromordinal(day_ordinal).strftime("%Y/%m/%d")
 
-    system = (
-        "あなたは自然文をGoogleスプレッドシート task-list への書き込み用JSONに変換するアシスタントです。"
-        "必ず intent, sheet, body の3要素を返します。"
-        "sheet は常に 'task-list'。"
-        "body には以下のキーを含めてください：固有ID, 追加日, 担当, 内容, 期限。"
-        f"固有IDは空文字列。追加日は必ず {today}。"
-        "担当は文章から名前を抽出。なければ空文字にしてください。"
-        "期限は文章から日付を抽出。なければ空文字にしてください。"
-        "質問文（例：誰が担当ですか？、期限はいつですか？）は出力に含めないこと。"
-        "内容はユーザー指示を簡潔に要約してください。"
-    )
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
+def today_str() -> str:
+    return _format_day(date.today().toordinal())
+
+
+@lru_cache(maxsize=1)  # 日付が変わるまでは同じ文字列を返す
+def system_prompt(today: str) -> str:
+    return _SYSTEM_PROMPT_PREFIX + f"追加日は必ず {today}。" + _SYSTEM_PROMPT_SUFFIX
+
+
+async def llm_infer(client: AsyncOpenAI, user_texts: list[str]) -> list:
+    """user_texts をまとめて LLM に渡し、入力ごとの JSON 文字列を同じ順序で返す。"""
+    system = system_prompt(today_str())
+
+    if len(user_texts) == 1:
+        resp = await create_completion(
+            client,
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": user_texts[0]},
+            ],
+            response_format=_GAS_RESPONSE_FORMAT,
+        )
+        return [resp.choices[0].message.content]
+
+    # 生のテキストを連結すると改行と番号で他の入力を装えるので、JSON配列として渡す
+    numbered = orjson.dumps([{"index": i, "text": text} for i, text in enumerate(user_texts, 1)]).decode()
+    resp = await create_completion(
+        client,
         messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user_text},
+            {"role": "system", "content": system + _BATCH_PROMPT_SUFFIX},
+            {"role": "user", "content": numbered},
         ],
-        response_format={"type": "json_schema", "json_schema": schema},
+        response_format=_GAS_BATCH_RESPONSE_FORMAT,
     )
+    items = _validate_llm_json(LLMBatchResp, resp.choices[0].message.content).items
+
+    # index が欠けている・重複している入力は、他人の結果を渡さないようその呼び出し元だけ失敗させる
+    by_index = {}
+    for item in items:
+        by_index.setdefault(item.index, []).append(item)
+
+    results = []
+    for i in range(1, len(user_texts) + 1):
+        matched = by_index.get(i, [])
+        if len(matched) == 1:
+            results.append(matched[0].model_dump_json(exclude={"index"}))
+        else:
+            results.append(HTTPException(status_code=502, detail=f"LLMのバッチ出力で入力 [{i}] の結果を特定できません"))
+    return results
 
-    content = resp.choices[0].message.content
+
+def _validate_llm_json(model: type[BaseModel], content: str):
     try:
-        data = json.loads(content)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=502, detail="LLM出力のJSON変換に失敗しました")
+        return model.model_validate_json(content)
+    except ValidationError as e:
+        if e.errors()[0]["type"] == "json_invalid":
+            raise HTTPException(status_code=502, detail="LLM出力のJSON変換に失敗しました")
+        raise HTTPException(status_code=502, detail=f"LLM出力がスキーマに一致しません: {e.errors()[0]['msg']}")
+
+
+def parse_llm_content(content: str) -> LLMResp:
+    return _validate_llm_json(LLMResp, content)
+
+
+async def _resolve_llm_content(batcher: MicroBatcher, redis: Redis | None, cache_key: str, user_text: str) -> str:
+    # Redis は高速化のためだけに使うので、落ちていても LLM 呼び出しで処理を続ける
+    if redis is not None:
+        try:
+            cached = await redis.get(f"llm:{cache_key}")
+        except RedisError as e:
+            logger.warning("LLM cache read failed: %s", e)
+        else:
+            if cached is not None:
+                return cached.decode()
+
+    content = await batcher.process_batched(user_text)
+    if redis is not None:
+        parse_llm_content(content)  # 検証を通った出力だけを共有する
+        try:
+            await redis.set(f"llm:{cache_key}", content, ex=LLM_CACHE_TTL)
+        except RedisError as e:
+            logger.warning("LLM cache write failed: %s", e)
+    return content
+
+
+async def fetch_llm_content(batcher: MicroBatcher, redis: Redis | None, cache_key: str, user_text: str) -> str:
+    # 取得と登録の間に await がないのでロックは不要
+    task = LLM_INFLIGHT.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_resolve_llm_content(batcher, redis, cache_key, user_text))
+        LLM_INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda _: LLM_INFLIGHT.pop(cache_key, None))
+    # 呼び出し元の1つが切断されても、共有の呼び出し自体は止めない
+    return await asyncio.shield(task)
+
+
+async def nl_to_gas_payload(batcher: MicroBatcher, user_text: str, redis: Redis | None = None) -> GasPayload:
+    today = today_str()
+    system = system_prompt(today)
+
+    cache_key = hashlib.sha256(f"{OPENAI_MODEL}|{system}|{user_text}".encode()).hexdigest()
+    content = LLM_CACHE.get(cache_key)
+    if content is None:
+        content = await fetch_llm_content(batcher, redis, cache_key, user_text)
+
+    parsed = parse_llm_content(content)
+
+    # 検証を通った出力のみキャッシュ（モデルではなく文字列で保持し、呼び出しごとに新しいモデルを作る）
+    LLM_CACHE[cache_key] = content
 
     # 追加日はサーバーで上書き
-    if "body" in data:
-        data["body"]["追加日"] = today
-
-    return GasPayload(
-        token="recora-secret-0324",
-        intent=data.get("intent", "create_task"),
-        sheet=data.get("sheet", "task-list"),
-        body=data.get("body", {}),
-    )
+    parsed.body.追加日 = today
+
+    return GasPayload(token=GAS_TOKEN, **parsed.model_dump())
+
+
+# ==== 未確定タスクの保存 ====
+async def load_pending(app: FastAPI, user_id: str) -> GasPayload | None:
+    redis = app.state.redis
+    if redis is None:
+        return pending_tasks.get(user_id)
+    raw = await redis.get(f"pending:{user_id}")
+    return GasPayload.model_validate_json(raw) if raw is not None else None
+
+
+async def save_pending(app: FastAPI, user_id: str, gas_payload: GasPayload):
+    redis = app.state.redis
+    if redis is None:
+        pending_tasks[user_id] = gas_payload
+    else:
+        await redis.set(f"pending:{user_id}", gas_payload.model_dump_json(), ex=PENDING_TTL)
+
+
+async def drop_pending(app: FastAPI, user_id: str):
+    redis = app.state.redis
+    if redis is None:
+        pending_tasks.pop(user_id, None)
+    else:
+        await redis.delete(f"pending:{user_id}")
 
 
 # ==== 検証関数 ====
@@ -138,69 +611,203 @@ def validate_task_fields(gas_payload: GasPayload):
 
 
 # ==== タスク登録 ====
-@app.post("/ingest")
-def ingest(payload: dict, x_api_key: str = Header(None), x_user_id: str = Header("default-user")):
+def verify_api_key(x_api_key: str = Header(None)):
     if (SERVER_API_KEY or "") != (x_api_key or ""):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    user_text = (payload.get("user_text") or "").strip()
-    if not user_text:
-        raise HTTPException(status_code=400, detail="user_text required")
+
+@app.post("/ingest", dependencies=[Depends(verify_api_key)])
+async def ingest(
+    request: Request,
+    req: IngestRequest,
+    background_tasks: BackgroundTasks,
+    wait: bool = False,  # true なら GAS への書き込み完了まで待って結果を返す
+    x_user_id: str = Header("default-user"),
+):
+    user_text = req.user_text
 
     # ---- 既に未確定タスクがある場合（multi-turn対応） ----
-    if x_user_id in pending_tasks:
-        prev = pending_tasks[x_user_id]
+    prev = await load_pending(request.app, x_user_id)
+    if prev is not None:
         body = prev.body
         # どちらが欠けているか確認して補完
         if not body.get("担当"):
-            body["担当"] = user_text.strip()
+            body["担当"] = user_text
         elif not body.get("期限"):
-            body["期限"] = user_text.strip()
+            body["期限"] = user_text
 
         # 再検証
         validation = validate_task_fields(prev)
         if validation["ok"]:
             # ✅ すべて揃ったので登録実行
-            del pending_tasks[x_user_id]
-            return send_to_gas(prev)
+            await drop_pending(request.app, x_user_id)
+            return await register_task(request.app, prev, background_tasks, wait)
         else:
-            # まだ足りない
+            # まだ足りない（補完した分を保存し直す）
+            await save_pending(request.app, x_user_id, prev)
             return validation
 
     # ---- 通常処理 ----
-    gas_payload = nl_to_gas_payload(user_text)
+    batcher = get_llm_batcher(request.app)
+    gas_payload = await nl_to_gas_payload(batcher, user_text, request.app.state.redis)
     validation = validate_task_fields(gas_payload)
     if not validation["ok"]:
         # 未確定ならpendingに保存
-        pending_tasks[x_user_id] = gas_payload
+        await save_pending(request.app, x_user_id, gas_payload)
         return validation
 
-    return send_to_gas(gas_payload)
+    return await register_task(request.app, gas_payload, background_tasks, wait)
+
+
+async def register_task(app: FastAPI, gas_payload: GasPayload, background_tasks: BackgroundTasks, wait: bool):
+    if wait:
+        return await send_to_gas(app, gas_payload)
+
+    # 設定漏れはその場で返し、GAS への書き込みはレスポンス送信後に行う
+    if not GAS_WEBAPP_URL:
+        raise HTTPException(status_code=500, detail="GAS_WEBAPP_URL is not set")
+    background_tasks.add_task(send_to_gas_in_background, app, gas_payload)
+    return {"ok": True, "queued": True, "message": "タスクの登録を受け付けました ✅"}
+
+
+# ==== 一括登録 ====
+@app.post("/batch-ingest", dependencies=[Depends(verify_api_key)])
+async def batch_ingest(request: Request, req: BatchIngest):
+    batcher = get_llm_batcher(request.app)
+    sem = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def one(item: IngestItem) -> GasPayload:
+        user_text = item.user_text.strip()
+        if not user_text:
+            raise HTTPException(status_code=400, detail="user_text required")
+        async with sem:
+            return await nl_to_gas_payload(batcher, user_text, request.app.state.redis)
+
+    payloads = await asyncio.gather(*(one(d) for d in req.items), return_exceptions=True)
+
+    # 1件の失敗でバッチ全体を止めず、項目ごとに結果を返す
+    results, rows = [], []
+    for i, (item, p) in enumerate(zip(req.items, payloads)):
+        result = {"id": item.id if item.id is not None else str(i)}
+        if isinstance(p, Exception):
+            result.update(status="error", error=p.detail if isinstance(p, HTTPException) else str(p))
+        else:
+            validation = validate_task_fields(p)
+            if validation["ok"]:
+                result["status"] = "ok"
+                rows.append((result, p))
+            else:
+                # 一括登録では聞き返しできないので未確定として返す
+                result.update(status="needs_user", error=validation["message"])
+        results.append(result)
+
+    if rows:
+        try:
+            await send_batch_to_gas(request.app, [p for _, p in rows])
+        except HTTPException as e:
+            for result, _ in rows:
+                result.update(status="error", error=e.detail)
+
+    return {"ok": all(r["status"] == "ok" for r in results), "results": results}
 
 
 # ==== GAS送信 ====
-def send_to_gas(gas_payload: GasPayload):
+_GAS_RETRY_STATUS = (429, 502, 503, 504)
+_GAS_HEAD_BYTES = 1024  # エラー表示に使う応答本文の先頭だけを読む
+
+
+class GasResponse(NamedTuple):
+    status_code: int
+    head: str  # 応答本文の先頭 _GAS_HEAD_BYTES バイト
+
+
+# GAS の一時的な失敗では LLM 呼び出しからやり直させず、GAS との通信だけを再試行する
+# 再試行し尽くした場合は最後の応答（または例外）をそのまま返す
+gas_retry = retry(
+    wait=wait_exponential(multiplier=0.3, max=3),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type(httpx.TransportError) | retry_if_result(lambda r: r.status_code in _GAS_RETRY_STATUS),
+    retry_error_callback=lambda state: state.outcome.result(),
+)
+
+
+@gas_retry
+async def _post_with_retry(app: FastAPI, body: str) -> GasResponse:
+    # GAS はデバッグ用 HTML などを返すことがあるので、本文全体は読み込まない
+    async with app.state.gas_client.stream(
+        "POST",
+        GAS_WEBAPP_URL,
+        content=body,
+        headers={"Content-Type": "application/json"},
+    ) as r:
+        head = b""
+        async for chunk in r.aiter_bytes():
+            head += chunk
+            if len(head) >= _GAS_HEAD_BYTES:
+                break
+        return GasResponse(r.status_code, head[:_GAS_HEAD_BYTES].decode("utf-8", errors="replace"))
+
+
+async def post_to_gas(app: FastAPI, body: str) -> GasResponse:
     if not GAS_WEBAPP_URL:
         raise HTTPException(status_code=500, detail="GAS_WEBAPP_URL is not set")
 
     try:
-        print(">>> GAS_PAYLOAD (send) =", json.dumps(gas_payload.model_dump(), ensure_ascii=False))
-        r = requests.post(
-            GAS_WEBAPP_URL,
-            headers={"Content-Type": "application/json"},
-            json=gas_payload.model_dump(),
-            timeout=20,
-        )
-        if not r.ok:
-            raise HTTPException(status_code=502, detail=f"GAS error: {r.text[:200]}")
-        return {"ok": True, "message": "タスクを登録しました ✅", "status": r.status_code}
-    except requests.RequestException as e:
+        logger.debug("GAS_PAYLOAD (send) = %s", body)
+        r = await _post_with_retry(app, body)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"GAS通信失敗: {e}")
 
+    if not 200 <= r.status_code < 300:
+        raise HTTPException(status_code=502, detail=f"GAS error: {r.head[:200]}")
+
+    # 書き込み後は一覧を取り直させる
+    TASKS_CACHE.clear()
+    return r
+
+
+def gas_batch_body(payloads: list[GasPayload]) -> str:
+    return GasBatch(token=GAS_TOKEN, batch=payloads).model_dump_json()
+
+
+async def write_gas_rows(app: FastAPI, payloads: list[GasPayload]) -> list[GasResponse]:
+    # gas_batcher から呼ばれる。1件だけなら従来どおり単体の形式で送る
+    if len(payloads) == 1:
+        r = await post_to_gas(app, payloads[0].model_dump_json())
+    else:
+        r = await post_to_gas(app, gas_batch_body(payloads))
+    return [r] * len(payloads)
+
+
+async def send_to_gas(app: FastAPI, gas_payload: GasPayload):
+    if app.state.gas_batcher is None:
+        r = await post_to_gas(app, gas_payload.model_dump_json())
+    else:
+        r = await app.state.gas_batcher.process_batched(gas_payload)
+    return {"ok": True, "message": "タスクを登録しました ✅", "status": r.status_code}
+
+
+async def send_to_gas_in_background(app: FastAPI, gas_payload: GasPayload):
+    # 呼び出し元には既に応答済みなので、失敗はログに残すだけにする
+    try:
+        await send_to_gas(app, gas_payload)
+    except HTTPException as e:
+        logger.error("GAS write failed (background): %s payload=%s", e.detail, gas_payload.model_dump_json(exclude={"token"}))
+
+
+async def send_batch_to_gas(app: FastAPI, payloads: list[GasPayload]):
+    r = await post_to_gas(app, gas_batch_body(payloads))
+    return {"ok": True, "message": f"{len(payloads)}件のタスクを登録しました ✅", "status": r.status_code}
+
 
 # ==== タスク取得 ====
+@gas_retry
+async def _get_with_retry(app: FastAPI, params: dict) -> httpx.Response:
+    return await app.state.gas_client.get(GAS_WEBAPP_URL, params=params)
+
+
 @app.get("/tasks")
-def get_tasks(user: str = None):
+async def get_tasks(request: Request, user: str = None, fresh: bool = False, if_none_match: str = Header(None)):
     if not GAS_WEBAPP_URL:
         raise HTTPException(status_code=500, detail="GAS_WEBAPP_URL is not set")
 
@@ -208,10 +815,20 @@ def get_tasks(user: str = None):
     if user:
         params["user"] = user
 
-    try:
-        r = requests.get(GAS_WEBAPP_URL, params=params, timeout=20)
-        r.raise_for_status()
-        data = r.json()
-        return data
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"GAS fetch failed: {e}")
+    key = (params["sheet"], user or "__all__")
+    cached = None if fresh else TASKS_CACHE.get(key)
+    if cached is None:
+        try:
+            r = await _get_with_retry(request.app, params)
+            r.raise_for_status()
+            orjson.loads(r.content)  # JSON として壊れていないことだけ確認し、本文は再エンコードしない
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            raise HTTPException(status_code=502, detail=f"GAS fetch failed: {e}")
+        cached = (r.content, f'"{hashlib.sha1(r.content).hexdigest()}"')
+        TASKS_CACHE[key] = cached
+
+    content, etag = cached
+    headers = {"ETag": etag}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)